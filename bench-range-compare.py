@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+
+# Benchmark for the range comparison pipeline used by compare-branches.py,
+# git-is-topic-upstream.py and patch-status.py.
+#
+# Generates a synthetic repository with 'git fast-import', with three ranges:
+#
+# upstream: base..upstream, unique upstream commits
+# vendor:   base..vendor, a mix of unique commits, cherry-picks of upstream
+#           commits and commits with titles colliding with upstream commits
+# rebased:  upstream..rebased, the vendor commits rebased on top of upstream,
+#           i.e. same patches with changed commit ids
+#
+# and times the collect, ingest, search and output phases of comparing the
+# ranges, first with a cold cache and then with a warm one. The results are
+# printed as JSON, so that runs can be compared.
+#
+# Some commits change multiple files, add empty files or rename files, so that
+# --verify (cross-checking patch_id.py against git) exercises the cases where
+# the patch-ids are the hardest to get right.
+#
+# E.g. bench-range-compare.py --commits 20000 -j 8 -o results.json
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from subprocess import PIPE
+
+import range_compare
+
+BRANCHES = {
+    'upstream': 'base..upstream',
+    'vendor': 'base..vendor',
+    'rebased': 'upstream..rebased',
+}
+
+WORDS = ['foo', 'bar', 'baz', 'dev', 'priv', 'ret', 'err', 'dma', 'buf', 'ctx',
+         'reg', 'val', 'irq', 'clk', 'pm', 'fmt', 'pad', 'sd', 'state', 'mux']
+
+class FastImport:
+    def __init__(self, path: Path):
+        self.proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=PIPE)
+        self.mark = 0
+        self.time = 1700000000
+
+    def _data(self, data: bytes):
+        self.proc.stdin.write(b'data %d\n' % len(data))
+        self.proc.stdin.write(data)
+        self.proc.stdin.write(b'\n')
+
+    def commit(self, branch: str, parent, title: str, files: dict[str, str]):
+        # Returns the mark of the new commit
+        self.mark += 1
+        self.time += 60
+
+        self.proc.stdin.write(f'commit refs/heads/{branch}\n'.encode())
+        self.proc.stdin.write(f'mark :{self.mark}\n'.encode())
+        self.proc.stdin.write(f'committer Bench <bench@example.com> {self.time} +0000\n'.encode())
+        self._data(f'{title}\n\nSynthetic commit {self.mark}\n'.encode())
+        if parent:
+            self.proc.stdin.write(f'from :{parent}\n'.encode())
+        for path, content in files.items():
+            # None removes the file
+            if content is None:
+                self.proc.stdin.write(f'D {path}\n'.encode())
+                continue
+            self.proc.stdin.write(f'M 100644 inline {path}\n'.encode())
+            self._data(content.encode())
+
+        return self.mark
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.proc.args)
+
+def random_patch(rng: random.Random, num_lines: int) -> str:
+    return ''.join(f'\t{rng.choice(WORDS)}_{rng.choice(WORDS)} = {rng.randrange(1 << 16)};\n'
+                   for _ in range(num_lines))
+
+def random_title(rng: random.Random, i: int) -> str:
+    return f'{rng.choice(WORDS)}: {rng.choice(WORDS)}: fix {rng.choice(WORDS)} handling ({i})'
+
+def generate_repo(path: Path, args):
+    # Every commit adds files of its own, so that cherry-picks and rebases
+    # apply cleanly and keep their patch-ids. The upstream commits renaming
+    # files are not cherry-picked, as the files don't exist in vendor.
+
+    rng = random.Random(args.seed)
+
+    subprocess.run(['git', 'init', '-q', str(path)], check=True)
+
+    fi = FastImport(path)
+
+    def new_patch(i):
+        files = { f'src/{i // 100}/{i}.c': random_patch(rng, args.lines) }
+        r = rng.random()
+        if r < args.multi_file:
+            files[f'include/{i // 100}/{i}.h'] = random_patch(rng, args.lines // 4 + 1)
+        elif r < args.multi_file + args.empty_files:
+            files[f'src/{i // 100}/{i}.empty'] = ''
+        return (random_title(rng, i), files)
+
+    i = 0
+    tip = None
+    for _ in range(args.base):
+        i += 1
+        tip = fi.commit('base', tip, *new_patch(i))
+    base = tip
+
+    upstream_patches = []
+    for _ in range(args.commits):
+        i += 1
+        if upstream_patches and rng.random() < args.renames:
+            # Rename a file added by an earlier upstream commit, with a small
+            # change so that the similarity is not 100%
+            title, files = upstream_patches.pop(rng.randrange(len(upstream_patches)))
+            old_path, content = next(iter(files.items()))
+            tip = fi.commit('upstream', tip, f'{title.split(":")[0]}: rename {i}',
+                            { old_path: None, f'{old_path}.renamed': content + random_patch(rng, 1) })
+            continue
+        upstream_patches.append(new_patch(i))
+        tip = fi.commit('upstream', tip, *upstream_patches[-1])
+    upstream = tip
+
+    vendor_patches = []
+    for _ in range(args.vendor):
+        r = rng.random()
+        if r < args.picks:
+            # Cherry-pick: same title and patch, different commit id
+            vendor_patches.append((*rng.choice(upstream_patches), True))
+        elif r < args.picks + args.title_collisions:
+            # Same title, different patch
+            i += 1
+            title = rng.choice(upstream_patches)[0]
+            vendor_patches.append((title, new_patch(i)[1], False))
+        else:
+            i += 1
+            vendor_patches.append((*new_patch(i), False))
+
+    tip = base
+    for title, files, _ in vendor_patches:
+        tip = fi.commit('vendor', tip, title, files)
+
+    tip = upstream
+    for title, files, is_pick in vendor_patches:
+        # Skip the patches already in upstream, as a rebase would
+        if is_pick:
+            continue
+        tip = fi.commit('rebased', tip, title, files)
+
+    fi.close()
+
+def write_output(datas, out_file: Path):
+    # Same output as compare-branches.py
+    with open(out_file, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+
+        cols = []
+        for b in BRANCHES:
+            cols += [b, b]
+
+        writer.writerow(['Title', *cols])
+
+        for data in datas:
+            columns = [c for b in BRANCHES for c in data.found.get(b, (None, None))]
+            writer.writerow([ data.title, *columns ])
+
+def run_benchmark(cache_name: str, workdir: Path, args):
+    timings = {}
+
+    t = time.perf_counter()
+
+    datas = range_compare.range_compare(BRANCHES, show_only_branch=None,
+                                        match_by_title=True, drop_common=False,
+                                        jobs=args.jobs, timings=timings, fuzzy=args.fuzzy)
+
+    t_output = time.perf_counter()
+    write_output(datas, workdir / 'branch-status.csv')
+    timings['output'] = time.perf_counter() - t_output
+
+    total = time.perf_counter() - t
+
+    return {
+        'cache': cache_name,
+        'phases': { k: round(v, 4) for k,v in timings.items() },
+        'total': round(total, 4),
+        'rows': len(datas),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the range comparison pipeline on a synthetic repository')
+    parser.add_argument('--commits', type=int, default=2000, help='Number of upstream commits (default=2000)')
+    parser.add_argument('--vendor', type=int, default=1000, help='Number of vendor commits (default=1000)')
+    parser.add_argument('--base', type=int, default=100, help='Number of commits in the common base (default=100)')
+    parser.add_argument('--picks', type=float, default=0.3, help='Fraction of vendor commits cherry-picked from upstream (default=0.3)')
+    parser.add_argument('--title-collisions', type=float, default=0.05, help='Fraction of vendor commits with an upstream title but a different patch (default=0.05)')
+    parser.add_argument('--lines', type=int, default=20, help='Number of lines added by each commit (default=20)')
+    parser.add_argument('--multi-file', type=float, default=0.2, help='Fraction of commits adding a second file (default=0.2)')
+    parser.add_argument('--empty-files', type=float, default=0.02, help='Fraction of commits adding an empty file too (default=0.02)')
+    parser.add_argument('--renames', type=float, default=0.02, help='Fraction of upstream commits renaming a file (default=0.02)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default=1)')
+    parser.add_argument('--warm-runs', type=int, default=1, help='Number of runs with a warm cache (default=1)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for computing patch-ids (default=1)')
+    parser.add_argument('--fuzzy', action='store_true', default=False, help='Enable fuzzy matching')
+    parser.add_argument('--verify', action='store_true', default=False, help='Cross-check the patch-ids of patch_id.py for all the commits against git patch-id')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep the generated repository')
+    parser.add_argument('-o', '--output', help='Write the results to this file instead of stdout')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='bench-range-compare-'))
+    repo = workdir / 'repo'
+
+    # Use a private cache, so that the cold runs are really cold
+    range_compare.COMMIT_CACHE_DIR = workdir / 'cache'
+
+    print(f'Generating repository at {repo}', file=sys.stderr)
+
+    t = time.perf_counter()
+    generate_repo(repo, args)
+    t_generate = time.perf_counter() - t
+
+    cwd = os.getcwd()
+    os.chdir(repo)
+
+    mismatches = None
+
+    try:
+        if args.verify:
+            import patch_id # pylint: disable=import-outside-toplevel
+
+            commitids = list(dict.fromkeys(c for r in BRANCHES.values() for c in range_compare.collect_commits(r)))
+            mismatches = patch_id.verify(commitids)
+
+            for commitid, native, git in mismatches:
+                print(f'{commitid}: native {native}, git {git}', file=sys.stderr)
+            print(f'{len(commitids) - len(mismatches)}/{len(commitids)} patch-ids match', file=sys.stderr)
+
+        runs = [run_benchmark('cold', workdir, args)]
+        for _ in range(args.warm_runs):
+            runs.append(run_benchmark('warm', workdir, args))
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f'Repository kept at {repo}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+    for r in runs:
+        phases = ' '.join(f'{k}={v:.3f}s' for k,v in r['phases'].items())
+        print(f'{r["cache"]:5} {phases} total={r["total"]:.3f}s', file=sys.stderr)
+
+    results = {
+        'params': { k: v for k,v in vars(args).items() if k not in ('keep', 'output', 'verify') },
+        'git': range_compare.run('git --version'),
+        'python': platform.python_version(),
+        'generate': round(t_generate, 4),
+        'runs': runs,
+    }
+
+    if mismatches is not None:
+        results['verify_mismatches'] = len(mismatches)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__=='__main__':
+    main()
@@ -2,14 +2,10 @@
 
 # pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
 
+import argparse
 import csv
-import pickle
-import subprocess
-import time
 
-from collections import defaultdict
-from pathlib import Path
-from subprocess import PIPE
+import range_compare
 
 # Branches (ranges) we're interested in
 BRANCHES = {
@@ -29,171 +25,94 @@ SHOW_ONLY_BRANCH = None
 # Use title matching in addition to commit ID and patch ID
 MATCH_BY_TITLE = True
 
+# Use matching by normalized title, i.e. without FROMLIST: etc. prefixes (see
+# range_compare.TITLE_RULES)
+MATCH_BY_NORMALIZED_TITLE = True
+
 # Drop commits that are found in all branches
 DROP_COMMON = False
 
 # output file
 OUT_FILE = 'branch-status.csv'
 
-# File used to cache data between runs
-COMMIT_CACHE_FILE = Path.home() / '.cache/patch-status.cache'
-
-def runasync(cmd):
-    return subprocess.Popen(cmd, stdout=PIPE, shell=True, universal_newlines=True)
-
-def run(cmd):
-    return subprocess.run(cmd, check=True, stdout=PIPE, shell=True, universal_newlines=True).stdout
-
-class CommitCache:
-    def __init__(self) -> None:
-        # commitid : { 'patchid': patch-id, 'title': title, 'files': [ files ] }
-        self.commit_map = {}
-        # patchid : [ commitid, commitid, ...]
-        self.patchid_idx: dict[str, list[str]] = defaultdict(list)
-        # title : [ commitid, commitid, ...]
-        self.title_idx: dict[str, list[str]] = defaultdict(list)
-
-    def add_commit(self, commitid: str):
-        if commitid in self.commit_map:
-            return
-
-        patchid = run(f'git show --no-decorate {commitid} | git patch-id --stable').strip().split(' ')[0]
-        title = run(f'git log --format=%s -n 1 {commitid}').strip()
-        #files = run(f'git diff-tree --no-commit-id --name-only -r {commitid}').rstrip().split('\n')
-        files = []
-
-        self.commit_map[commitid] = { 'patchid': patchid, 'title': title, 'files': files }
-
-        self.patchid_idx[patchid].append(commitid)
-        self.title_idx[title].append(commitid)
-
-    def get_patch_id(self, commitid: str) -> str:
-        return self.commit_map[commitid]['patchid']
+# File used to store the results between runs, so that the next run only needs
+# to process the changes in the branches. None to always process everything.
+STATE_FILE = 'branch-status.state'
 
-    def get_title(self, commitid: str) -> str:
-        return self.commit_map[commitid]['title']
+def nway(args):
+    # One row per patch-id, with the names of the branches containing it,
+    # instead of two columns per branch
+    membership = range_compare.branch_membership(BRANCHES, jobs=args.jobs)
 
-    def get_patch_id_commits(self, patchid: str) -> list[str]:
-        return self.patchid_idx[patchid]
+    present = list(args.present or [])
+    if SHOW_ONLY_BRANCH:
+        present.append(SHOW_ONLY_BRANCH)
 
-    def get_title_commits(self, title: str) -> list[str]:
-        return self.title_idx[title]
+    all_mask = membership.mask(BRANCHES)
+    keys = [key for key in membership.query(present, args.absent or [])
+            if not (DROP_COMMON and membership.masks[key] == all_mask)]
 
-    def load(self):
-        if COMMIT_CACHE_FILE.is_file():
-            with open(COMMIT_CACHE_FILE, 'rb') as handle:
-                data = pickle.load(handle)
-                self.commit_map, self.patchid_idx, self.title_idx = data
-            print(f'Cache loaded with {len(self.commit_map)} commits')
+    print('Commits per branch:')
+    for name, count in membership.branch_counts().items():
+        print(f'  {name:20} {count}')
 
-    def save(self):
-        with open(COMMIT_CACHE_FILE, 'wb') as handle:
-            data = (self.commit_map, self.patchid_idx, self.title_idx)
-            pickle.dump(data, handle)
+    print('Common commits:')
+    for (a, b), count in membership.overlaps().items():
+        print(f'  {a:20} {b:20} {count}')
 
-        print(f'Cache saved with {len(self.commit_map)} commits')
-
-
-def collect_commits(commitrange):
-    print(f'Collecting commits {commitrange}: ', end='')
-
-    proc = runasync(f'git rev-list --no-merges {commitrange}')
-
-    commits = []
-
-    while True:
-        line = proc.stdout.readline()
-        if line == '' and proc.poll() is not None:
-            break
-
-        line = line.rstrip()
+    print(f'Creating {OUT_FILE}')
 
-        commits.append(line)
+    with open(OUT_FILE, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
 
-    print(f'{len(commits)} commits')
+        writer.writerow(['Title', 'Commit', 'Branches'])
 
-    return commits
+        for key in keys:
+            writer.writerow([ membership.titles[key], membership.commits[key][0],
+                              ' '.join(membership.branch_names(membership.masks[key])) ])
 
+    print(f'Created {OUT_FILE}')
+    print(f'Total {len(keys)} commits')
 
 def main():
-    cache = CommitCache()
-
-    cache.load()
-
-    branches = { name: collect_commits(range) for name,range in BRANCHES.items() }
-
-    flattened = [item for sublist in branches.values() for item in sublist]
-
-    print('Generating database')
-
-    i = 0
-    timestamp = 0
-    for commitid in flattened:
-        if time.time() > timestamp + 10:
-            print(f'  {i}/{len(flattened)}')
-            timestamp = time.time()
-        i += 1
-        cache.add_commit(commitid)
-    print(f'  {i}/{len(flattened)}')
-
-    cache.save()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for computing patch-ids (default=1)')
+    parser.add_argument('--fuzzy', action='store_true', default=False, help='Search the commits not found otherwise by similarity')
+    parser.add_argument('-n', '--nway', action='store_true', default=False, help='Match by patch-id only, and list the branches containing each patch in one column')
+    parser.add_argument('-p', '--present', action='append', choices=BRANCHES, help='With --nway, list only the patches in this branch (can be given multiple times)')
+    parser.add_argument('-x', '--absent', action='append', choices=BRANCHES, help='With --nway, list only the patches not in this branch (can be given multiple times)')
+    args = parser.parse_args()
+
+    range_compare.VERBOSE = True
+
+    if args.nway:
+        nway(args)
+        return
+
+    datas = range_compare.range_compare(BRANCHES, show_only_branch=SHOW_ONLY_BRANCH,
+                                        match_by_title=MATCH_BY_TITLE,
+                                        drop_common=DROP_COMMON, jobs=args.jobs,
+                                        state_file=STATE_FILE, fuzzy=args.fuzzy,
+                                        match_by_normalized_title=MATCH_BY_NORMALIZED_TITLE)
 
     print(f'Creating {OUT_FILE}')
 
-    def search_for_commit_in_branch(commitid, branch_name):
-        if commitid in branches[branch_name]:
-            return (commitid, 'CommitID')
-
-        pid = cache.get_patch_id(commitid)
-        for c in cache.get_patch_id_commits(pid):
-            if c in branches[branch_name]:
-                return (c, 'PatchID')
-
-        if MATCH_BY_TITLE:
-            title = cache.get_title(commitid)
-            for c in cache.get_title_commits(title):
-                if c in branches[branch_name]:
-                    return (c, 'Title')
-
-        return (None, None)
-
     with open(OUT_FILE, 'w', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
 
         cols = []
-        for b in branches:
+        for b in BRANCHES:
             cols += [b, b]
 
         writer.writerow(['Title', *cols])
 
-        if SHOW_ONLY_BRANCH:
-            commit_list = branches[SHOW_ONLY_BRANCH]
-        else:
-            commit_list = flattened
-
-        timestamp = 0
-        for i, commitid in enumerate(commit_list):
-            if time.time() > timestamp + 10:
-                print(f'  {i}/{len(commit_list)}')
-                timestamp = time.time()
-
-            found = [search_for_commit_in_branch(commitid, b) for b in branches]
-
-            is_common = all(x != (None, None) for x in found)
-
-            if DROP_COMMON and is_common:
-                continue
-
-            columns = [c for l in found for c in l]
-
-            data = [ cache.get_title(commitid), *columns ]
-
-            writer.writerow(data)
+        for data in datas:
+            columns = [c for b in BRANCHES for c in data.found.get(b, (None, None))]
 
-        print(f'  {len(commit_list)}/{len(commit_list)}')
+            writer.writerow([ data.title, *columns ])
 
     print(f'Created {OUT_FILE}')
-    print(f'Total {len(commit_list)} commits')
+    print(f'Total {len(datas)} commits')
 
 
 if __name__=='__main__':
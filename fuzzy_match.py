@@ -0,0 +1,233 @@
+#!/usr/bin/python3
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+
+# Fuzzy matching of commits, for patches which were reworded or had a hunk
+# changed before being merged, so that neither the patch-id nor the title
+# matches.
+#
+# Each commit is described by a set of features: the lines it adds and
+# removes (without whitespace, like patch-id), the files it changes and the
+# words of its title. The similarity of two commits is the Jaccard index of
+# their feature sets, estimated with MinHash signatures of NUM_PERM values.
+# The signatures are stored in a database next to the commit cache, so they
+# are computed only once per commit.
+#
+# To avoid comparing every commit to every other commit, the signatures are
+# indexed with LSH: each signature is split into BANDS bands, and only the
+# commits sharing at least one band are compared. With 16 bands of 4 rows, a
+# pair of commits with a similarity of 0.6 is compared with a probability of
+# ~0.9, and with a similarity of 0.7 with a probability of ~0.99.
+#
+# E.g. fuzzy_match.py 1234abcd v6.9..v6.10
+
+import argparse
+import hashlib
+import multiprocessing
+import random
+import re
+import sqlite3
+
+from array import array
+from pathlib import Path
+
+import range_compare
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+
+# Default minimum similarity for a match
+THRESHOLD = 0.6
+
+# Buckets with more commits than this are ignored when searching, so that
+# commits with only a few very common lines don't make the search quadratic
+MAX_BUCKET = 200
+
+# Stored in PRAGMA user_version. Change when the features or the hashing
+# change, to recompute the signatures.
+SIGNATURE_VERSION = 1
+
+# Each of the NUM_PERM hash functions is the feature hash XORed with a mask
+_rng = random.Random(0x5eed)
+MASKS = [_rng.getrandbits(64) for _ in range(NUM_PERM)]
+
+# Number of commits handled by one git process
+CHUNK_SIZE = 500
+
+def _hash(feature: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(feature, digest_size=8).digest(), 'little')
+
+def minhash(features) -> array:
+    hashes = [_hash(f) for f in features]
+    return array('I', (min(h ^ m for h in hashes) >> 32 for m in MASKS))
+
+def similarity(sig1: array, sig2: array) -> float:
+    return sum(a == b for a, b in zip(sig1, sig2)) / NUM_PERM
+
+def diff_features(commitids):
+    # Returns [(commitid, features)] for the given commits, from a single
+    # git log
+    results = []
+
+    for commitid, title, files, lines in range_compare.diff_lines(commitids):
+        features = set(b't:' + w for w in re.findall(rb'\w+', title.lower()))
+        features.update(b'f:' + f for f in files)
+        features.update(line[:1] + line[1:].translate(None, b' \t\r') for line in lines)
+        results.append((commitid, features))
+
+    return results
+
+def _signature_chunk(commitids):
+    # Commits without features (empty commits) get an empty signature
+    return [(c, minhash(features) if features else array('I'))
+            for c, features in diff_features(commitids)]
+
+def get_signature_file() -> Path:
+    cache_file = range_compare.get_cache_file()
+    return cache_file.with_name(f'{cache_file.stem}-minhash.db')
+
+class SignatureCache:
+    # MinHash signatures of the commits, as arrays of NUM_PERM 32 bit values,
+    # in an SQLite database next to the commit cache. Like CommitCache, the
+    # API uses hex commit ids.
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS signatures (
+            commitid BLOB PRIMARY KEY,
+            signature BLOB NOT NULL
+        )
+    '''
+
+    def __init__(self, cache_file: Path = None) -> None:
+        # Defaults to the signature cache of the current repository
+        self.cache_file = cache_file
+        self.db: sqlite3.Connection = None
+
+    def load(self):
+        if self.cache_file is None:
+            self.cache_file = get_signature_file()
+
+        self.db = range_compare.connect_db(self.cache_file)
+
+        self.db.execute('BEGIN IMMEDIATE')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SIGNATURE_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS signatures')
+        self.db.execute(self.SCHEMA)
+        self.db.execute(f'PRAGMA user_version = {SIGNATURE_VERSION}')
+        self.db.commit()
+
+    def _select(self, query: str, commitids: list):
+        return range_compare.select_in(self.db, query, [bytes.fromhex(c) for c in commitids])
+
+    def add_commits(self, commitids: list[str], jobs=1):
+        commitids = list(dict.fromkeys(commitids))
+        known = set(r[0].hex() for r in self._select('SELECT commitid FROM signatures WHERE commitid IN ({})', commitids))
+        todo = [c for c in commitids if c not in known]
+
+        if range_compare.VERBOSE:
+            print(f'Computing {len(todo)} MinHash signatures, {len(known)} already in cache')
+
+        chunks = [todo[i:i + CHUNK_SIZE] for i in range(0, len(todo), CHUNK_SIZE)]
+
+        def store(rows):
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO signatures VALUES (?, ?)',
+                                    ((bytes.fromhex(c), sig.tobytes()) for c, sig in rows))
+
+        if jobs > 1 and len(chunks) > 1:
+            with multiprocessing.Pool(min(jobs, len(chunks))) as pool:
+                for rows in pool.imap(_signature_chunk, chunks):
+                    store(rows)
+        else:
+            for chunk in chunks:
+                store(_signature_chunk(chunk))
+
+    def get_signatures(self, commitids: list[str]) -> dict:
+        # Returns { commitid: signature } for the given commits, except the
+        # empty ones
+        signatures = {}
+        for commitid, blob in self._select('SELECT commitid, signature FROM signatures WHERE commitid IN ({})', commitids):
+            if blob:
+                signatures[commitid.hex()] = array('I', blob)
+        return signatures
+
+def _band_keys(signature: array):
+    for i in range(BANDS):
+        yield hash((i, signature[i * ROWS:(i + 1) * ROWS].tobytes()))
+
+class LSHIndex:
+    # The commits can be identified with anything hashable, e.g. hex strings
+    # or binary commit ids
+
+    def __init__(self) -> None:
+        # { band key: commit, or [commit, ...] if multiple }
+        self.buckets = {}
+        # { commit: signature }
+        self.signatures = {}
+
+    def add(self, commit, signature: array) -> None:
+        self.signatures[commit] = signature
+
+        for key in _band_keys(signature):
+            old = self.buckets.get(key)
+            if old is None:
+                self.buckets[key] = commit
+            elif isinstance(old, list):
+                old.append(commit)
+            else:
+                self.buckets[key] = [old, commit]
+
+    def query(self, signature: array, threshold=THRESHOLD) -> list:
+        # Returns [(commit, similarity)] for the commits with an estimated
+        # similarity of at least threshold, the most similar first
+        candidates = set()
+        for key in _band_keys(signature):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                continue
+            if not isinstance(bucket, list):
+                candidates.add(bucket)
+            elif len(bucket) <= MAX_BUCKET:
+                candidates.update(bucket)
+
+        results = []
+        for commit in candidates:
+            score = similarity(signature, self.signatures[commit])
+            if score >= threshold:
+                results.append((commit, score))
+
+        results.sort(key=lambda r: r[1], reverse=True)
+
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the commits in a range most similar to a commit')
+    parser.add_argument('commit', help='Commit to search for')
+    parser.add_argument('range', help='Commit range to search')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD, help=f'Minimum similarity (default={THRESHOLD})')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default=1)')
+    args = parser.parse_args()
+
+    commitid = range_compare.run(f'git rev-parse {args.commit}^{{commit}}')
+    commitids = range_compare.collect_commits(args.range)
+
+    cache = SignatureCache()
+    cache.load()
+    cache.add_commits(commitids + [commitid], args.jobs)
+
+    signatures = cache.get_signatures(commitids + [commitid])
+    if commitid not in signatures:
+        print(f'{args.commit} is an empty commit')
+        return
+
+    index = LSHIndex()
+    for c in commitids:
+        if c in signatures:
+            index.add(c, signatures[c])
+
+    for c, score in index.query(signatures[commitid], args.threshold):
+        print(f'{score:.2f} {range_compare.run(f"git log -1 --oneline {c}")}')
+
+if __name__=='__main__':
+    main()
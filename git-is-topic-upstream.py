@@ -3,17 +3,127 @@
 # pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
 
 import argparse
+import itertools
+import subprocess
 import range_compare
 import time
 
+from collections import defaultdict
+from subprocess import PIPE
 from xtermcolor import colorize
 
-def is_empty_commit(commitid):
-    # XXX is there a better way to detect an empty commit?
-    t1 = range_compare.run(f'git rev-parse {commitid}^{{tree}}')
-    t2 = range_compare.run(f'git rev-parse {commitid}^^{{tree}}')
-
-    return t1 == t2
+def get_commit_info(commitids):
+    # Returns { commitid: (short commitid, is empty) } for the given commits,
+    # with a single git log. A commit is empty if its tree is the same as its
+    # parent's, i.e. there's no raw diff.
+    if not commitids:
+        return {}
+
+    out = subprocess.run(['git', 'log', '--no-walk=unsorted', '--stdin', '--no-renames',
+                          '--raw', '--format=commit %H %h'],
+                         check=True, stdout=PIPE, universal_newlines=True,
+                         input=''.join(f'{c}\n' for c in commitids)).stdout
+
+    info = {}
+    commitid = None
+    for line in out.splitlines():
+        if line.startswith('commit '):
+            _, commitid, short = line.split()
+            info[commitid] = (short, True)
+        elif line.startswith(':'):
+            info[commitid] = (info[commitid][0], False)
+
+    return info
+
+# Number of right side commits searched at a time with --quick. The chunks
+# start small, so that a topic merged recently is found quickly, and grow to
+# keep the per-chunk overhead low.
+QUICK_CHUNK_MIN = 64
+QUICK_CHUNK_MAX = 4096
+
+def quick_compare(left, right, drop_common, limit, jobs=1, match_by_normalized_title=True):
+    # Like range_compare.range_compare() for the 'left' and 'right' ranges,
+    # but only returns the left commits. The patch-ids of the left commits
+    # are computed first, and then the right commits, newest first, until
+    # all the left commits have been found by commit id or patch-id, or
+    # 'limit' commits have been searched. Returns the results and the number
+    # of right commits searched.
+
+    cache = range_compare.CommitCache()
+    cache.load()
+
+    topic = range_compare.collect_commits(left)
+    cache.add_commits(topic, jobs)
+
+    # { patchid: [commitid, ...] }, { title: [commitid, ...] } and
+    # { normalized title: [commitid, ...] } of the topic
+    patchid_map = defaultdict(list)
+    title_map = defaultdict(list)
+    normalized_title_map = defaultdict(list)
+    for c in topic:
+        patchid_map[cache.get_patch_id(c)].append(c)
+        title_map[cache.get_title(c)].append(c)
+        if match_by_normalized_title:
+            normalized_title_map[cache.get_normalized_title(c)].append(c)
+
+    # { commitid: (right commitid, match type) }
+    found = {}
+    # Commits not found yet by commit id or patch-id. A title match doesn't
+    # stop the search, as a later commit may match the patch-id.
+    remaining = set(topic)
+
+    num_searched = 0
+    chunk_size = QUICK_CHUNK_MIN
+
+    proc = range_compare.runasync(f'git rev-list --no-merges --max-count={limit} {right}')
+
+    try:
+        while remaining:
+            chunk = [line.rstrip() for line in itertools.islice(proc.stdout, chunk_size)]
+            if not chunk:
+                break
+
+            cache.add_commits(chunk, jobs)
+
+            for c in chunk:
+                if c in remaining:
+                    found[c] = (c, 'CommitID')
+                    remaining.discard(c)
+
+                for t in patchid_map.get(cache.get_patch_id(c), []):
+                    if t in remaining:
+                        found[t] = (c, 'PatchID')
+                        remaining.discard(t)
+
+                for t in title_map.get(cache.get_title(c), []):
+                    if t not in found or found[t][1] == 'NormTitle':
+                        found[t] = (c, 'Title')
+
+                if match_by_normalized_title:
+                    for t in normalized_title_map.get(cache.get_normalized_title(c), []):
+                        if t not in found:
+                            found[t] = (c, 'NormTitle')
+
+            num_searched += len(chunk)
+            chunk_size = min(chunk_size * 2, QUICK_CHUNK_MAX)
+    finally:
+        proc.kill()
+        proc.wait()
+
+    cache.save()
+
+    datas = []
+    for c in topic:
+        if drop_common and c in found:
+            continue
+
+        res = { 'left': (c, 'CommitID') }
+        if c in found:
+            res['right'] = found[c]
+
+        datas.append(range_compare.Result(c, cache.get_title(c), res))
+
+    return datas, num_searched
 
 def main():
     parser = argparse.ArgumentParser()
@@ -23,6 +133,12 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true', default=False)
     parser.add_argument('-l', '--left-only', action='store_true', default=False, help='Show only commits in left')
     parser.add_argument('-r', '--right-only', action='store_true', default=False, help='Show only commits in right')
+    parser.add_argument('-e', '--skip-empty', action='store_true', default=False, help='Skip empty commits')
+    parser.add_argument('-q', '--quick', action='store_true', default=False, help='Show only the commits in left, and stop searching right when all have been found')
+    parser.add_argument('--limit', type=int, default=10000, help='With --quick, the number of commits in right to search at most (default=10000)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes for computing patch-ids (default=1)')
+    parser.add_argument('--fuzzy', action='store_true', default=False, help='Search the commits not found otherwise by similarity (not with --quick)')
+    parser.add_argument('--no-norm-title', action='store_true', default=False, help='Do not match by normalized title, i.e. without FROMLIST: etc. prefixes')
     args = parser.parse_args()
 
     range_compare.VERBOSE = args.verbose
@@ -36,14 +152,22 @@ def main():
         'right': f'{args.right} ^{merge_base}',
     }
 
-    datas = range_compare.range_compare(branches, show_only_branch=[],
-                                        match_by_title=True, drop_common=not args.all)
-
-    commitid_len = 0
+    if args.quick:
+        datas, num_searched = quick_compare(branches['left'], branches['right'], drop_common=not args.all,
+                                            limit=args.limit, jobs=args.jobs,
+                                            match_by_normalized_title=not args.no_norm_title)
+        if args.verbose:
+            print(f'Searched {num_searched} commits')
+    else:
+        datas = range_compare.range_compare(branches, show_only_branch=[],
+                                            match_by_title=True, drop_common=not args.all,
+                                            jobs=args.jobs, fuzzy=args.fuzzy,
+                                            match_by_normalized_title=not args.no_norm_title)
 
     shown_commits = set()
 
-    lines = []
+    # [(side, match type, color, left commitid, right commitid, data)]
+    entries = []
 
     if args.verbose:
         print(f'Processing {len(datas)} entries')
@@ -55,11 +179,6 @@ def main():
                 print(f'  {i}/{len(datas)}')
             timestamp = time.time()
 
-        commitid = data.commitid
-
-        #if is_empty_commit(commitid):
-        #    continue
-
         in_left = 'left' in data.found
         in_right = 'right' in data.found
 
@@ -105,21 +224,29 @@ def main():
         else:
             raise RuntimeError()
 
+        entries.append((side, match_type, c, lcommit, rcommit, data))
+
+    # Abbreviate the commit ids, and find the empty commits, in one go
+    info = get_commit_info(set(c for e in entries for c in (e[3], e[4], e[5].commitid) if c))
+
+    commitid_len = 0
+
+    for side, match_type, c, lcommit, rcommit, data in entries:
+        if args.skip_empty and info[data.commitid][1]:
+            continue
+
         if lcommit:
-            lcommit = range_compare.shorten_commitid(lcommit)
+            lcommit = info[lcommit][0]
 
         if rcommit:
-            rcommit = range_compare.shorten_commitid(rcommit)
+            rcommit = info[rcommit][0]
 
         if not commitid_len:
             commitid_len = max(len(lcommit), len(rcommit))
 
         s = f'{side} {match_type} {lcommit:{commitid_len}} {rcommit:{commitid_len}} {data.title}'
 
-        lines.append(colorize(s, rgb=c))
-
-    for l in lines:
-        print(l)
+        print(colorize(s, rgb=c))
 
 if __name__=='__main__':
     main()
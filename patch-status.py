@@ -1,14 +1,17 @@
 #!/usr/bin/python3
 
+import argparse
+import hashlib
 import subprocess
 from subprocess import PIPE
 import pygit2
-import pickle
 import os
 import csv
 import time
 from collections import defaultdict
 
+import range_compare
+
 #from patch_status_ti import *
 from patch_status_renesas import *
 #from patch_status_cruise import *
@@ -16,13 +19,18 @@ from patch_status_renesas import *
 # output file
 OUT_FILE = "patch-status.csv"
 
-# File used to cache data between runs
-COMMIT_CACHE_FILE="/home/tomba/work/patch-status.cache"
+# File used to store the results between runs, so that the next run only needs
+# to process the changes in the ranges. None to always process everything.
+STATE_FILE = "patch-status.state"
 
 # Optional file where old custom column data will be read from
 OLD_COMMIT_FILE = None
 #OLD_COMMIT_FILE = 'patch-status-2.csv'
 
+# Use matching by normalized title, i.e. without FROMLIST: etc. prefixes (see
+# range_compare.TITLE_RULES)
+MATCH_BY_NORMALIZED_TITLE = True
+
 # Columns handled by this script
 AUTO_COLUMNS = ["Number", "Commit", "Title", "Author", "Committer", "Category",
 	"Upstream Commit", "Upstream Found by", "Upstream Range"]
@@ -37,47 +45,25 @@ def runasync(cmd):
 def run(cmd):
 	return subprocess.run(cmd, check=True, stdout=PIPE, shell=True, universal_newlines=True).stdout
 
-# commitid : { "patchid": patch-id, "title": title, "files": [ files ] }
-commit_map = {}
-
-def get_entry(oid):
-	id = str(oid)
-	d = commit_map.get(id)
-	if d == None:
-		d = {}
-		commit_map[id] = d
-	return d
+# Cache shared with the other tools using range_compare
+cache = range_compare.CommitCache()
 
 def get_patch_id(oid):
-	d = get_entry(oid)
-
-	id = d.get("patchid")
-	if id == None:
-		id = run("git show --no-decorate {} | git patch-id --stable".format(oid)).strip().split(" ")[0]
-		d["patchid"] = id
-
-	return id
+	return cache.get_patch_id(str(oid))
 
 def get_title(oid):
-	d = get_entry(oid)
+	return cache.get_title(str(oid))
 
-	title = d.get("title")
-	if title == None:
-		title = repo.get(oid).message.split("\n", 1)[0]
-		d["title"] = title
+def get_normalized_title(oid):
+	return cache.get_normalized_title(str(oid))
 
-	return title
+def add_commits(oids):
+	# Fill in patch-ids and titles for all the given commits with a single
+	# git log | git patch-id pipeline
+	cache.add_commits([str(oid) for oid in oids], args.jobs)
 
 def get_files(oid):
-	d = get_entry(oid)
-
-	files = d.get("files")
-	if files == None:
-		files = run("git diff-tree --no-commit-id --name-only -r {}".format(oid))
-		files = files.rstrip().split("\n")
-		d["files"] = files
-
-	return files
+	return cache.get_files(str(oid))
 
 def filter_commit_by_people(cid):
 	commit = repo.get(cid)
@@ -98,20 +84,10 @@ def filter_commit(cid):
 	#return filter_commit_by_path(cid)
 
 def load_cache():
-	global commit_map
-
-	if os.path.isfile(COMMIT_CACHE_FILE):
-		with open(COMMIT_CACHE_FILE, 'rb') as handle:
-			commit_map = pickle.load(handle)
-		print("Cache loaded with {} commits".format(len(commit_map)))
+	cache.load()
 
 def save_cache():
-	global commit_map
-
-	with open(COMMIT_CACHE_FILE, 'wb') as handle:
-		pickle.dump(commit_map, handle)
-
-	print("Cache saved with {} commits".format(len(commit_map)))
+	cache.save()
 
 def collect_commits(range):
 	print("Collecting commits {}".format(range))
@@ -120,19 +96,41 @@ def collect_commits(range):
 
 	proc = runasync("git rev-list --reverse --no-merges {}".format(range))
 
-	while True:
-		line = proc.stdout.readline()
-		if line == '' and proc.poll() != None:
-			break
+	for line in proc.stdout:
+		list.append(pygit2.Oid(hex=line.rstrip()))
 
-		line = line.rstrip()
-
-		list.append(pygit2.Oid(hex=line))
+	if proc.wait() != 0:
+		raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
 	print("  Found {} commits".format(len(list)))
 
 	return list;
 
+def iter_commit_batches(range, size):
+	# Like collect_commits(), but yields the commits in batches of 'size'
+	# commits, without collecting the whole range
+	print("Collecting commits {}".format(range))
+
+	batch = []
+	num = 0
+
+	proc = runasync("git rev-list --reverse --no-merges {}".format(range))
+
+	for line in proc.stdout:
+		batch.append(pygit2.Oid(hex=line.rstrip()))
+		num += 1
+		if len(batch) == size:
+			yield batch
+			batch = []
+
+	if proc.wait() != 0:
+		raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+	if batch:
+		yield batch
+
+	print("  Found {} commits".format(num))
+
 old_commits = {}
 old_extra_columns = []
 
@@ -183,134 +181,340 @@ def drop_duplicates(commits):
 
 	return l
 
-# Main code
+# Previous results, if the configuration hasn't changed
+old_state = None
+
+# { range: resolved range }
+state_tips = {}
+# { range: [commitid, ...] }
+state_commits = {}
+# Commits added to or removed from the ranges since the previous run
+changed_commits = set()
+
+def get_options():
+	# The results can be reused only if these haven't changed
+	return (VENDOR, UPSTREAMS, args.fuzzy,
+		range_compare.title_rules_hash() if MATCH_BY_NORMALIZED_TITLE else None)
+
+def load_state():
+	global old_state
 
-load_old()
+	if STATE_FILE == None or args.low_memory:
+		return
+
+	old_state = range_compare.load_state(STATE_FILE)
 
-load_cache()
+	if old_state != None and old_state["options"] != get_options():
+		old_state = None
 
-vendor_commits = collect_commits(VENDOR)
-vendor_commits = drop_duplicates(vendor_commits)
+	if old_state != None:
+		print("Loaded previous results from '{}'".format(STATE_FILE))
 
-print("Filtering interesting commits...")
-vendor_commits = [cid for cid in vendor_commits if filter_commit(cid)]
-print("  found {} interesting commits".format(len(vendor_commits)))
+def save_state(results):
+	if STATE_FILE == None or args.low_memory:
+		return
 
-upstream_commits = { tree: [cid for cid in collect_commits(tree)] for tree in UPSTREAMS }
-flattened = [i for sublist in [upstream_commits[k] for k in upstream_commits] for i in sublist]
+	range_compare.save_state(STATE_FILE, { "options": get_options(),
+		"tips": state_tips, "commits": state_commits, "results": results })
+
+def collect_range(range):
+	# Like collect_commits(), but reuses the commits from the previous run if
+	# the range hasn't changed
+	tip = range_compare.resolve_range(range)
+	state_tips[range] = tip
+
+	if old_state != None and old_state["tips"].get(range) == tip:
+		commits = [pygit2.Oid(hex=cid) for cid in old_state["commits"][range]]
+		print("Range {} unchanged, {} commits".format(range, len(commits)))
+	else:
+		commits = collect_commits(range)
+		if old_state != None and range in old_state["commits"]:
+			changed_commits.update(set(old_state["commits"][range]) ^ set(str(cid) for cid in commits))
+
+	state_commits[range] = [str(cid) for cid in commits]
+
+	return commits
+
+# Number of upstream commits handled at a time with --low-memory
+BATCH_SIZE = 10000
+
+# The upstream indexes use compact keys and values, as they can have millions
+# of entries: 20 byte binary commit ids and patch-ids, 16 byte title digests,
+# and the index of the range in UPSTREAMS.
+
+# { commitid: range index }, the first range in UPSTREAMS containing the commit
+upstream_range_map = {}
+# { patchid: commitid, or [commitid, ...] if multiple }
+patchid_map = {}
+# { title digest: commitid, or [commitid, ...] if multiple }
+title_map = {}
+# { normalized title digest: commitid, or [commitid, ...] if multiple }
+normalized_title_map = {}
+
+def title_digest(title):
+	return hashlib.blake2b(title.encode(), digest_size=16).digest()
+
+def add_to_map(map, key, cid):
+	old = map.get(key)
+	if old == None:
+		map[key] = cid
+	elif isinstance(old, list):
+		old.append(cid)
+	else:
+		map[key] = [old, cid]
+
+def get_from_map(map, key):
+	# Returns the list of commits for the key, as Oids
+	cids = map[key]
+	if not isinstance(cids, list):
+		cids = [cids]
+	return [pygit2.Oid(raw=cid) for cid in cids]
+
+def index_upstream_commits(oids, range_index):
+	for oid in oids:
+		cid = oid.raw
+
+		if cid in upstream_range_map:
+			continue
 
-print("generating { patchid: [commitid, ...] }")
-patchid_map = defaultdict(set)
-i = 0
-timestamp = 0
-for cid in flattened:
-	if time.time() > timestamp + 10:
-		print("  {}/{}".format(i, len(flattened)))
-		timestamp = time.time()
-	i += 1
-	pid = get_patch_id(cid)
-	patchid_map[pid].add(cid)
+		upstream_range_map[cid] = range_index
+		add_to_map(patchid_map, bytes.fromhex(get_patch_id(oid)), cid)
+		add_to_map(title_map, title_digest(get_title(oid)), cid)
+		if MATCH_BY_NORMALIZED_TITLE:
+			add_to_map(normalized_title_map, title_digest(get_normalized_title(oid)), cid)
 
-print("generating { title: [commitid, ...] }")
-title_map = defaultdict(set)
-i = 0
-timestamp = 0
-for cid in flattened:
-	if time.time() > timestamp + 10:
-		print("  {}/{}".format(i, len(flattened)))
-		timestamp = time.time()
-	i += 1
-	title = get_title(cid)
-	title_map[title].add(cid)
+# With --fuzzy, the cache of the MinHash signatures, and the LSH index of the
+# upstream commits, by binary commit id
+signature_cache = None
+fuzzy_index = None
 
-save_cache()
+def index_fuzzy(oids):
+	if not args.fuzzy:
+		return
 
-print("Creating " + OUT_FILE)
+	cids = [str(oid) for oid in oids]
+	signature_cache.add_commits(cids, args.jobs)
 
-num_in_target = defaultdict(int)
+	for cid, signature in signature_cache.get_signatures(cids).items():
+		fuzzy_index.add(bytes.fromhex(cid), signature)
 
 def get_upstream_range(oid):
-	assert(oid in flattened)
+	return UPSTREAMS[upstream_range_map[oid.raw]]
+
+# Patch-ids and titles of the changed commits. The search result of a vendor
+# commit can change only if it shares one of these.
+changed_pids = set()
+changed_titles = set()
+changed_normalized_titles = set()
+
+def is_affected(oid):
+	return (str(oid) in changed_commits or get_patch_id(oid) in changed_pids or
+		get_title(oid) in changed_titles or
+		(MATCH_BY_NORMALIZED_TITLE and get_normalized_title(oid) in changed_normalized_titles))
+
+old_results = {}
+
+# { commitid: (upstream commitid, found by, upstream range) }, for the state file
+results = {}
+
+def search_for_commit_cached(oid):
+	# Returns the result from the previous run, if it can't have changed
+	cid = str(oid)
+
+	# The fuzzy matches, or the lack of them, depend on all the upstream
+	# commits
+	if (cid in old_results and not is_affected(oid) and
+		not (args.fuzzy and (old_results[cid][1] == None or old_results[cid][1].startswith("Fuzzy")))):
+		res = old_results[cid]
+	else:
+		upoid, found, uprange = search_for_commit(oid)
+		res = (str(upoid) if upoid != None else None, found, uprange)
 
-	for k in UPSTREAMS:
-		if oid in upstream_commits[k]:
-			return k
+	if not args.low_memory:
+		results[cid] = res
 
-	assert(False)
+	return res
 
 def search_for_commit(oid):
-	if oid in flattened:
+	if oid.raw in upstream_range_map:
 		return (oid, "Merge", get_upstream_range(oid))
 
-	pid = get_patch_id(oid)
+	pid = bytes.fromhex(get_patch_id(oid))
 	if pid in patchid_map:
-		if len(patchid_map[pid]) > 1:
+		ucids = get_from_map(patchid_map, pid)
+		if len(ucids) > 1:
 			print("WARNING: multiple matching commits for the same patch-id (picking the first one)")
-			for ucid in patchid_map[pid]:
+			for ucid in ucids:
 				print("  ", ucid, get_upstream_range(ucid))
 
-		ucid = list(patchid_map[pid])[0]
+		ucid = ucids[0]
 		return (ucid, "PatchID", get_upstream_range(ucid))
 
-	title = get_title(oid)
+	title = title_digest(get_title(oid))
 	if title in title_map:
-		if len(title_map[title]) > 1:
+		ucids = get_from_map(title_map, title)
+		if len(ucids) > 1:
 			print("WARNING: multiple matching commits for the same title (picking the first one)")
-			for ucid in title_map[title]:
+			for ucid in ucids:
 				print("  ", ucid, get_upstream_range(ucid))
 
-		ucid = list(title_map[title])[0]
+		ucid = ucids[0]
 		return (ucid, "Title", get_upstream_range(ucid))
 
+	title = title_digest(get_normalized_title(oid)) if MATCH_BY_NORMALIZED_TITLE else None
+	if title in normalized_title_map:
+		ucids = get_from_map(normalized_title_map, title)
+		if len(ucids) > 1:
+			print("WARNING: multiple matching commits for the same normalized title (picking the first one)")
+			for ucid in ucids:
+				print("  ", ucid, get_upstream_range(ucid))
+
+		ucid = ucids[0]
+		return (ucid, "NormTitle", get_upstream_range(ucid))
+
+	if args.fuzzy:
+		signature = signature_cache.get_signatures([str(oid)]).get(str(oid))
+		matches = fuzzy_index.query(signature) if signature else []
+		if matches:
+			ucid, score = matches[0]
+			ucid = pygit2.Oid(raw=ucid)
+			return (ucid, "Fuzzy {:.2f}".format(score), get_upstream_range(ucid))
+
 	return (None, None, None)
 
-with open(OUT_FILE, 'w', newline='') as csvfile:
+# Main code. This must not run at import time, as the worker processes
+# computing the patch-ids may import this file again (with the spawn and
+# forkserver start methods of multiprocessing).
 
-	writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+def main():
+	global args
+	global signature_cache, fuzzy_index
+	global changed_pids, changed_titles, changed_normalized_titles
+	global old_results
 
-	writer.writerow(AUTO_COLUMNS + old_extra_columns)
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes for computing patch-ids (default=1)")
+	parser.add_argument("--low-memory", action="store_true", default=False, help="Process the upstream ranges in batches, without keeping the commit lists in memory. Disables the reuse of the previous results.")
+	parser.add_argument("--fuzzy", action="store_true", default=False, help="Search the commits not found otherwise by similarity")
+	args = parser.parse_args()
 
-	last = time.time()
-	i = 0
-	for oid in vendor_commits:
-		i = i + 1
+	range_compare.VERBOSE = True
 
-		commit = repo.get(oid)
+	load_old()
 
-		upoid, found, uprange = search_for_commit(oid)
+	load_cache()
+
+	load_state()
+
+	vendor_commits = collect_range(VENDOR)
+
+	print("Adding vendor commits to cache")
+	add_commits(vendor_commits)
+
+	vendor_commits = drop_duplicates(vendor_commits)
+
+	print("Filtering interesting commits...")
+	vendor_commits = [cid for cid in vendor_commits if filter_commit(cid)]
+	print("  found {} interesting commits".format(len(vendor_commits)))
+
+	if args.fuzzy:
+		import fuzzy_match
+
+		signature_cache = fuzzy_match.SignatureCache()
+		signature_cache.load()
+
+		fuzzy_index = fuzzy_match.LSHIndex()
+
+	print("Adding upstream commits to cache and generating the upstream indexes")
+
+	if args.low_memory:
+		for range_index, tree in enumerate(UPSTREAMS):
+			for batch in iter_commit_batches(tree, BATCH_SIZE):
+				add_commits(batch)
+				index_upstream_commits(batch, range_index)
+				index_fuzzy(batch)
+	else:
+		upstream_commits = { tree: [cid for cid in collect_range(tree)] for tree in UPSTREAMS }
+		flattened = [i for sublist in [upstream_commits[k] for k in upstream_commits] for i in sublist]
+
+		# The removed commits are needed to find the affected vendor commits
+		add_commits(flattened + list(changed_commits))
+
+		for range_index, tree in enumerate(UPSTREAMS):
+			index_upstream_commits(upstream_commits[tree], range_index)
+
+		index_fuzzy(flattened)
+
+		del upstream_commits, flattened
+
+	if args.fuzzy:
+		signature_cache.add_commits([str(oid) for oid in vendor_commits], args.jobs)
+
+	save_cache()
+
+	print("Creating " + OUT_FILE)
+
+	num_in_target = defaultdict(int)
+
+	changed_pids = set(get_patch_id(cid) for cid in changed_commits)
+	changed_titles = set(get_title(cid) for cid in changed_commits)
+	if MATCH_BY_NORMALIZED_TITLE:
+		changed_normalized_titles = set(get_normalized_title(cid) for cid in changed_commits)
+
+	old_results = old_state["results"] if old_state != None else {}
+
+	with open(OUT_FILE, 'w', newline='') as csvfile:
+
+		writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+
+		writer.writerow(AUTO_COLUMNS + old_extra_columns)
+
+		last = time.time()
+		i = 0
+		for oid in vendor_commits:
+			i = i + 1
+
+			commit = repo.get(oid)
+
+			upoid, found, uprange = search_for_commit_cached(oid)
+
+			if upoid != None:
+				num_in_target[uprange] += 1
+
+				if uprange in DROP_UPSTREAMED:
+					continue
 
-		if upoid != None:
-			num_in_target[uprange] += 1
+			files = get_files(oid)
+			category = ""
+			for cat, paths in CATEGORIES.items():
+				if any(file.startswith(paths) for file in files):
+					category = cat
+					break
 
-			if uprange in DROP_UPSTREAMED:
-				continue
+			# AUTO_COLUMNS
+			data = [ i, oid, get_title(oid), commit.author.name, commit.committer.name, category,
+				upoid, found, uprange ]
 
-		files = get_files(oid)
-		category = ""
-		for cat, paths in CATEGORIES.items():
-			if any(file.startswith(paths) for file in files):
-				category = cat
-				break
+			old = old_commits.get(str(oid))
+			if old != None:
+				for column in old_extra_columns:
+					data += [ old[column] ]
 
-		# AUTO_COLUMNS
-		data = [ i, oid, get_title(oid), commit.author.name, commit.committer.name, category,
-			upoid, found, uprange ]
+			writer.writerow(data)
 
-		old = old_commits.get(str(oid))
-		if old != None:
-			for column in old_extra_columns:
-				data += [ old[column] ]
+			if time.time() > last + 5:
+				print("  {}/{}".format(i, len(vendor_commits)))
+				last = time.time()
 
-		writer.writerow(data)
+		print("  {}/{}".format(len(vendor_commits), len(vendor_commits)))
 
-		if time.time() > last + 5:
-			print("  {}/{}".format(i, len(vendor_commits)))
-			last = time.time()
+	save_cache()
 
-	print("  {}/{}".format(len(vendor_commits), len(vendor_commits)))
+	save_state(results)
 
-save_cache()
+	print("Total {} commits".format(len(vendor_commits)))
+	for k,v in num_in_target.items():
+		print("{}: {}".format(k, v))
 
-print("Total {} commits".format(len(vendor_commits)))
-for k,v in num_in_target.items():
-	print("{}: {}".format(k, v))
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+
+# pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
+
+# In-process computation of 'git patch-id --stable' compatible patch-ids,
+# using pygit2 to produce the diffs. This is an independent implementation for
+# cross-checking, not a faster one: producing the diffs with libgit2 is several
+# times slower than the single 'git log -p | git patch-id' pipeline the tools
+# use (see range_compare.git_patch_ids()).
+#
+# patch_id_from_diff() is a port of get_one_patchid() in git's
+# builtin/patch-id.c. Binary diffs are hashed by git using the abbreviated
+# blob ids from the 'index' line, and the abbreviation length is not
+# something we can reliably reproduce, so commits with binary changes fall
+# back to running git. So do renames and copies, as libgit2 computes the
+# similarity index differently, and files without hunks, for which libgit2
+# gives header lines that git doesn't.
+#
+# Run with --verify to cross-check the results against the git binary.
+
+import argparse
+import hashlib
+import multiprocessing
+import random
+import re
+import sys
+
+import pygit2
+
+import range_compare
+
+HUNK_HEADER_RE = re.compile(rb'@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))?')
+
+# Number of commits handled at a time, both by the worker processes and for
+# the commits which need to be passed to git
+CHUNK_SIZE = 256
+
+def _remove_space(line: bytes) -> bytes:
+    # git's isspace()
+    return line.translate(None, b' \t\n\r')
+
+def patch_id_from_diff(lines) -> str:
+    # Returns the stable patch-id for the diff 'lines' (bytes), or an empty
+    # string if there's nothing to hash, like git patch-id.
+
+    result = 0
+    ctx = hashlib.sha1()
+    patchlen = 0
+    before = after = -1
+    diff_is_binary = False
+    pre_oid = post_oid = b''
+
+    def flush():
+        # Sum of the per-file hashes, as 160-bit little endian numbers
+        nonlocal result, ctx
+        result = (result + int.from_bytes(ctx.digest(), 'little')) % (1 << 160)
+        ctx = hashlib.sha1()
+
+    for line in lines:
+        if line.startswith(b'\\ ') and len(line) > 12:
+            continue
+
+        # Ignore commit comments
+        if not patchlen and not line.startswith(b'diff '):
+            continue
+
+        # Parsing diff header?
+        if before == -1:
+            if line.startswith(b'GIT binary patch') or line.startswith(b'Binary files'):
+                diff_is_binary = True
+                before = 0
+                ctx.update(pre_oid)
+                ctx.update(post_oid)
+                flush()
+                continue
+
+            if line.startswith(b'index '):
+                ids = line[6:].rstrip(b'\n').split(b' ')[0].split(b'..')
+                if len(ids) == 2:
+                    pre_oid, post_oid = ids
+                continue
+
+            if line.startswith(b'--- '):
+                before = after = 1
+            elif not line[:1].isalpha():
+                break
+
+        if diff_is_binary:
+            if line.startswith(b'diff '):
+                diff_is_binary = False
+                before = -1
+            continue
+
+        # Looking for a valid hunk header?
+        if before == 0 and after == 0:
+            if line.startswith(b'@@ -'):
+                # Parse next hunk, but ignore line numbers
+                m = HUNK_HEADER_RE.match(line)
+                if m:
+                    before = int(m[1]) if m[1] is not None else 1
+                    after = int(m[2]) if m[2] is not None else 1
+                continue
+
+            # Split at the end of the patch
+            if not line.startswith(b'diff '):
+                break
+
+            # Else we're parsing another header
+            flush()
+            before = after = -1
+
+        # If we get here, we're inside a hunk
+        if line[:1] in (b'-', b' '):
+            before -= 1
+        if line[:1] in (b'+', b' '):
+            after -= 1
+
+        line = _remove_space(line)
+        patchlen += len(line)
+        ctx.update(line)
+
+    flush()
+
+    if not patchlen:
+        return ''
+
+    return result.to_bytes(20, 'little').hex()
+
+def commit_title(commit: pygit2.Commit) -> str:
+    # Same as git's %s: the first paragraph of the message, joined to a
+    # single line
+    lines = []
+    for line in commit.message.lstrip('\n').split('\n'):
+        line = line.rstrip()
+        if not line:
+            break
+        lines.append(line)
+
+    return ' '.join(lines)
+
+def commit_patch_id(repo: pygit2.Repository, commit: pygit2.Commit):
+    # Returns the patch-id of the commit, or None if it has to be computed
+    # with git
+
+    if commit.parents:
+        diff = repo.diff(commit.parents[0], commit)
+    else:
+        diff = commit.tree.diff_to_tree(swap=True)
+
+    # Detect renames according to diff.renames, as git show would
+    diff.find_similar()
+
+    datas = []
+    for patch in diff:
+        # Binary detection is only reliable after the patch has been generated
+        data = patch.data
+        if patch.delta.is_binary:
+            return None
+
+        # The similarity index of libgit2 can differ from git's, and it's
+        # part of the hashed header
+        if patch.delta.status_char() in ('R', 'C'):
+            return None
+
+        # libgit2 gives ---/+++ lines for the files without hunks (e.g. an
+        # empty file added or removed), git doesn't
+        if not patch.hunks:
+            return None
+
+        datas.append(data)
+
+    # Each patch ends with a newline, so only the last split gives an extra
+    # empty line, which is where patch_id_from_diff() stops anyway
+    return patch_id_from_diff(b''.join(datas).split(b'\n'))
+
+_repo = None
+
+def _patch_id_chunk(commitids):
+    # The repository is opened once per (worker) process
+    global _repo # pylint: disable=global-statement
+    if _repo is None:
+        _repo = pygit2.Repository('.')
+
+    results = {}
+    fallback = []
+
+    for commitid in commitids:
+        commit = _repo.get(commitid)
+        patchid = commit_patch_id(_repo, commit)
+        if patchid is None:
+            fallback.append(commitid)
+        else:
+            results[commitid] = (commitid, patchid, commit_title(commit))
+
+    for row in range_compare.git_patch_ids(fallback):
+        results[row[0]] = row
+
+    return [results[c] for c in commitids]
+
+def stream_patch_ids(commitids, jobs=1):
+    # Yields (commitid, patchid, title) for the given commits, in order, like
+    # range_compare.stream_patch_ids()
+
+    commitids = list(commitids)
+    chunks = [commitids[i:i + CHUNK_SIZE] for i in range(0, len(commitids), CHUNK_SIZE)]
+
+    if jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(jobs, len(chunks))) as pool:
+            for results in pool.imap(_patch_id_chunk, chunks):
+                yield from results
+    else:
+        for chunk in chunks:
+            yield from _patch_id_chunk(chunk)
+
+def verify(commitids):
+    # Compares the native patch-ids and titles of the given commits to the
+    # ones from git. Returns a list of (commitid, native, git) tuples for the
+    # commits which differ.
+
+    native = list(stream_patch_ids(commitids))
+    git = list(range_compare.git_patch_ids(commitids))
+
+    return [(n[0], n[1:], g[1:]) for n, g in zip(native, git) if n != g]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute stable patch-ids with pygit2')
+    parser.add_argument('range', nargs='?', default='HEAD~1000..HEAD', help='Commit range (default=HEAD~1000..HEAD)')
+    parser.add_argument('--verify', action='store_true', default=False, help='Cross-check the patch-ids against git patch-id')
+    parser.add_argument('-n', '--sample', type=int, default=100, help='Number of random commits to verify, 0 for all (default=100)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default=1)')
+    args = parser.parse_args()
+
+    commitids = range_compare.collect_commits(args.range)
+
+    if not args.verify:
+        for commitid, patchid, _ in stream_patch_ids(commitids, args.jobs):
+            print(patchid, commitid)
+        return
+
+    if args.sample and args.sample < len(commitids):
+        commitids = random.sample(commitids, args.sample)
+
+    mismatches = verify(commitids)
+
+    for commitid, native, git in mismatches:
+        print(f'{commitid}: native {native}, git {git}')
+
+    print(f'{len(commitids) - len(mismatches)}/{len(commitids)} commits match')
+
+    if mismatches:
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
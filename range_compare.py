@@ -2,18 +2,69 @@
 
 # pylint: disable=missing-module-docstring, missing-function-docstring, missing-class-docstring
 
+import hashlib
+import multiprocessing
+import os
 import pickle
+import re
+import sqlite3
 import subprocess
+import threading
 import time
 
-from collections import defaultdict
+from collections import deque
 from pathlib import Path
 from subprocess import PIPE
 
 VERBOSE = False
 
-# File used to cache data between runs
-COMMIT_CACHE_FILE = Path.home() / '.cache/patch-status.cache'
+# Directory for the files used to cache data between runs. There's a separate
+# cache file for each repository.
+COMMIT_CACHE_DIR = Path.home() / '.cache/patch-status'
+
+# Normalization of the commit titles for matching by normalized title. The
+# rules are (regex, replacement) pairs, applied until the title doesn't change
+# anymore, so that stacked prefixes are all removed.
+#
+# The normalized titles are stored in the commit cache, which is shared by all
+# the tools, so the rules must be the same for all of them. Changing the rules
+# here recomputes the normalized titles of the whole cache on the next run.
+TITLE_RULES = [
+    # FROMLIST:, UPSTREAM:, BACKPORT: etc.
+    (r'^(?:FROMLIST|FROMGIT|UPSTREAM|BACKPORT|ANDROID|CHROMIUM|LOCAL|WIP)\s*:\s*', ''),
+    # [PATCH v3 2/5], [RFC PATCH] etc.
+    (r'^\[[^]]*\]\s*', ''),
+]
+# Reverts are normalized to 'Revert "<normalized title>"', so that a revert
+# only matches a revert of the same commit, never the reverted commit itself
+TITLE_REVERT_RE = r'^Revert "(.*)"$'
+TITLE_IGNORE_CASE = True
+# Collapse and strip whitespace
+TITLE_IGNORE_WHITESPACE = True
+
+def normalize_title(title: str) -> str:
+    prev = None
+    while title != prev:
+        prev = title
+        for regex, replacement in TITLE_RULES:
+            title = re.sub(regex, replacement, title.strip())
+
+    m = re.match(TITLE_REVERT_RE, title)
+    if m:
+        title = f'Revert "{normalize_title(m[1])}"'
+
+    if TITLE_IGNORE_CASE:
+        title = title.lower()
+
+    if TITLE_IGNORE_WHITESPACE:
+        title = ' '.join(title.split())
+
+    return title
+
+def title_rules_hash() -> str:
+    # Identifies the normalization, to know when it has changed
+    rules = (TITLE_RULES, TITLE_REVERT_RE, TITLE_IGNORE_CASE, TITLE_IGNORE_WHITESPACE)
+    return hashlib.sha1(repr(rules).encode()).hexdigest()
 
 def runasync(cmd):
     return subprocess.Popen(cmd, stdout=PIPE, shell=True, universal_newlines=True)
@@ -21,61 +72,394 @@ def runasync(cmd):
 def run(cmd):
     return subprocess.run(cmd, check=True, stdout=PIPE, shell=True, universal_newlines=True).stdout.strip()
 
+def stream_patch_ids(commitids, jobs=1):
+    # Yields (commitid, patchid, title) for the given commits, in order.
+    #
+    # With jobs > 1 the commits are split into chunks which are handled by a
+    # pool of worker processes, each running its own pipeline. The results
+    # are still yielded in the original order.
+
+    commitids = list(commitids)
+
+    if jobs > 1 and len(commitids) > 1:
+        yield from _parallel_patch_ids(commitids, jobs)
+    else:
+        yield from git_patch_ids(commitids)
+
+def _patch_id_chunk(commitids):
+    return list(git_patch_ids(commitids))
+
+def _parallel_patch_ids(commitids, jobs):
+    # Small enough chunks to keep all the workers busy until the end, and to
+    # get regular progress updates, but large enough that the process startup
+    # costs don't matter
+    chunk_size = min(max(len(commitids) // (jobs * 8), 1), 2000)
+
+    chunks = [commitids[i:i + chunk_size] for i in range(0, len(commitids), chunk_size)]
+
+    with multiprocessing.Pool(min(jobs, len(chunks))) as pool:
+        for results in pool.imap(_patch_id_chunk, chunks):
+            yield from results
+
+def git_patch_ids(commitids):
+    # All commits go through a single 'git log -p' piped to a single
+    # 'git patch-id --stable', instead of forking per commit. We sit in the
+    # middle of the pipe to pick up the commit titles. Commits without a diff
+    # get an empty patch-id, like 'git show | git patch-id' would give.
+
+    if not commitids:
+        return
+
+    log_cmd = ['git', 'log', '--no-walk=unsorted', '--stdin', '--root', '-p',
+               '--no-decorate', '--no-color', '--no-ext-diff',
+               '--format=commit %H%ntitle %s']
+    pid_cmd = ['git', 'patch-id', '--stable']
+
+    log_proc = subprocess.Popen(log_cmd, stdin=PIPE, stdout=PIPE)
+    pid_proc = subprocess.Popen(pid_cmd, stdin=PIPE, stdout=PIPE)
+
+    titles = {}
+    # Commits fed to patch-id, but not yet yielded
+    pending = deque()
+
+    def pump():
+        try:
+            log_proc.stdin.write(''.join(f'{c}\n' for c in commitids).encode())
+            log_proc.stdin.close()
+
+            for line in log_proc.stdout:
+                if line.startswith(b'commit '):
+                    commitid = line[7:].strip().decode()
+                    title = next(log_proc.stdout)[6:].rstrip(b'\n')
+                    titles[commitid] = title.decode(errors='replace')
+                    pending.append(commitid)
+
+                pid_proc.stdin.write(line)
+
+            pid_proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            # The consumer stopped early and the processes were killed
+            pass
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+
+    try:
+        for line in pid_proc.stdout:
+            patchid, commitid = line.decode().split()
+
+            while (c := pending.popleft()) != commitid:
+                yield (c, '', titles.pop(c))
+
+            yield (commitid, patchid, titles.pop(commitid))
+
+        thread.join()
+
+        while pending:
+            c = pending.popleft()
+            yield (c, '', titles.pop(c))
+
+        for proc, cmd in ((log_proc, log_cmd), (pid_proc, pid_cmd)):
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, cmd)
+    finally:
+        for proc in (log_proc, pid_proc):
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        thread.join()
+
+def diff_lines(commitids, pretty='%s'):
+    # Returns [(commitid, header, files, lines)] for the given commits, from a
+    # single git log -p -U0. The header is the commit formatted with 'pretty',
+    # files are the paths from the ---/+++ lines, and lines are the added and
+    # removed lines, with their +/-, which is what git log -G matches against.
+    # All but the commit ids are bytes.
+    out = subprocess.run(['git', 'log', '--no-walk=unsorted', '--stdin', '-p', '-U0',
+                          '--no-color', '--no-ext-diff', f'--format=commit %H {pretty}'],
+                         check=True, stdout=PIPE,
+                         input=''.join(f'{c}\n' for c in commitids).encode()).stdout
+
+    results = []
+    in_hunk = False
+
+    for line in out.split(b'\n'):
+        if line.startswith(b'commit '):
+            _, commitid, header = (line + b' ').split(b' ', 2)
+            files = []
+            lines = []
+            results.append((commitid.decode(), header[:-1], files, lines))
+            in_hunk = False
+        elif line.startswith(b'diff '):
+            in_hunk = False
+        elif line.startswith(b'@@'):
+            in_hunk = True
+        elif in_hunk:
+            if line[:1] in (b'+', b'-'):
+                lines.append(line)
+        elif line.startswith(b'+++ ') or line.startswith(b'--- '):
+            files.append(line[4:])
+
+    return results
+
+# Maximum number of keys in one query, as SQLite limits the number of
+# variables in a statement
+SQL_BATCH_SIZE = 500
+
+def select_in(db: sqlite3.Connection, query: str, keys: list):
+    # Yields the rows of 'query' for the keys, where the query has '{}' in
+    # place of the list of the IN clause. The keys are queried in batches.
+    for i in range(0, len(keys), SQL_BATCH_SIZE):
+        batch = keys[i:i + SQL_BATCH_SIZE]
+        yield from db.execute(query.format(','.join('?' * len(batch))), batch)
+
+def connect_db(db_file: Path) -> sqlite3.Connection:
+    # Opens the database in WAL mode, so that multiple processes can use it
+    # at the same time (see CommitCache)
+    db_file.parent.mkdir(parents=True, exist_ok=True)
+
+    db = sqlite3.connect(db_file, timeout=CommitCache.DB_TIMEOUT)
+    db.execute('PRAGMA journal_mode = WAL')
+
+    return db
+
+def get_cache_file() -> Path:
+    # The repository is identified by its common git directory, so worktrees
+    # share the cache with their main repository. The name of the repository
+    # is included in the file name to make it easy to find (and remove) the
+    # cache of a particular repository.
+
+    gitdir = Path(run('git rev-parse --path-format=absolute --git-common-dir')).resolve()
+
+    name = gitdir.parent.name if gitdir.name == '.git' else gitdir.name
+    digest = hashlib.sha1(str(gitdir).encode()).hexdigest()[:12]
+
+    return COMMIT_CACHE_DIR / f'{name}-{digest}.db'
+
 class CommitCache:
-    def __init__(self) -> None:
-        # commitid : { 'patchid': patch-id, 'title': title, 'files': [ files ] }
-        self.commit_map = {}
-        # patchid : [ commitid, commitid, ...]
-        self.patchid_idx: dict[str, list[str]] = defaultdict(list)
-        # title : [ commitid, commitid, ...]
-        self.title_idx: dict[str, list[str]] = defaultdict(list)
+    # The cache is an SQLite database with a table of commits, indexed on the
+    # commit id, patch id and title. Lookups go directly to the database, and
+    # only the new commits are written to it.
+    #
+    # To keep the database and its indexes compact, the commit ids and patch
+    # ids are stored as 20 byte blobs, and each title is stored only once, in
+    # the titles table. The API still uses hex strings.
+    #
+    # The commits also refer to their normalized title (see normalize_title()),
+    # in the titles table too. The hash of the normalization rules is stored
+    # in the meta table, and the normalized titles are recomputed if the rules
+    # change.
+    #
+    # The database is in WAL mode, so multiple tools can use the same cache
+    # at the same time: readers never block each other or the writer, and
+    # writers wait for each other (up to DB_TIMEOUT seconds).
+
+    DB_TIMEOUT = 300
+
+    # Stored in PRAGMA user_version. The pickled cache used before, in
+    # ~/.cache/patch-status.cache, is not converted: the commits are simply
+    # added again.
+    SCHEMA_VERSION = 1
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS titles (
+            titleid INTEGER PRIMARY KEY,
+            title TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS commits (
+            commitid BLOB PRIMARY KEY,
+            patchid BLOB NOT NULL,
+            titleid INTEGER NOT NULL REFERENCES titles,
+            files TEXT,
+            normtitleid INTEGER REFERENCES titles
+        );
+        CREATE INDEX IF NOT EXISTS commits_patchid ON commits (patchid);
+        CREATE INDEX IF NOT EXISTS commits_titleid ON commits (titleid);
+        CREATE INDEX IF NOT EXISTS commits_normtitleid ON commits (normtitleid);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    '''
+
+    def __init__(self, cache_file: Path = None) -> None:
+        # Defaults to the cache of the current repository
+        self.cache_file = cache_file
+        self.db: sqlite3.Connection = None
+
+    def has_commit(self, commitid: str) -> bool:
+        row = self.db.execute('SELECT 1 FROM commits WHERE commitid = ?', (bytes.fromhex(commitid),)).fetchone()
+        return row is not None
 
     def add_commit(self, commitid: str):
-        if commitid in self.commit_map:
+        self.add_commits([commitid])
+
+    def add_commits(self, commitids: list[str], jobs=1):
+        # Only the commits not already in the cache, without duplicates
+        todo = [c for c in dict.fromkeys(commitids) if not self.has_commit(c)]
+
+        if VERBOSE:
+            print(f'  {len(commitids) - len(todo)} commits already in cache')
+
+        if not todo:
             return
 
-        patchid = run(f'git show --no-decorate {commitid} | git patch-id --stable').split(' ')[0]
-        title = run(f'git log --format=%s -n 1 {commitid}')
+        # New rows are written in batches, each batch in its own short
+        # transaction, so that other processes using the cache are blocked
+        # only briefly. This also means that an interrupted run keeps most
+        # of the work done.
+        rows = []
+
+        def flush():
+            self._insert(rows)
+            self.db.commit()
+            rows.clear()
+
+        i = 0
+        timestamp = 0
+        try:
+            for row in stream_patch_ids(todo, jobs):
+                if time.time() > timestamp + 10:
+                    if VERBOSE:
+                        print(f'  {i}/{len(todo)}')
+                    timestamp = time.time()
+                    flush()
+                i += 1
+
+                rows.append(row)
+        finally:
+            flush()
+
+        if VERBOSE:
+            print(f'  {i}/{len(todo)}')
+
+    def _insert(self, rows):
+        # rows: [(commitid, patchid, title)], as hex strings and text
+        rows = [(bytes.fromhex(c), bytes.fromhex(p), t, normalize_title(t)) for c, p, t in rows]
 
-        self.commit_map[commitid] = { 'patchid': patchid, 'title': title, }
+        self.db.executemany('INSERT OR IGNORE INTO titles (title) VALUES (?)',
+                            ((title,) for row in rows for title in row[2:]))
+        self.db.executemany('''INSERT OR IGNORE INTO commits (commitid, patchid, titleid, normtitleid)
+                               VALUES (?, ?, (SELECT titleid FROM titles WHERE title = ?),
+                                       (SELECT titleid FROM titles WHERE title = ?))''', rows)
 
-        self.patchid_idx[patchid].append(commitid)
-        self.title_idx[title].append(commitid)
+    def _get(self, column: str, commitid: str):
+        row = self.db.execute(f'SELECT {column} FROM commits NATURAL JOIN titles WHERE commitid = ?',
+                              (bytes.fromhex(commitid),)).fetchone()
+        if row is None:
+            raise KeyError(commitid)
+        return row[0]
 
     def get_patch_id(self, commitid: str) -> str:
-        return self.commit_map[commitid]['patchid']
+        return self._get('patchid', commitid).hex()
 
     def get_title(self, commitid: str) -> str:
-        return self.commit_map[commitid]['title']
+        return self._get('title', commitid)
+
+    def get_patch_ids(self, commitids: list[str]) -> dict:
+        # Returns { commitid: patchid } for the given commits
+        rows = select_in(self.db, 'SELECT commitid, patchid FROM commits WHERE commitid IN ({})',
+                         [bytes.fromhex(c) for c in commitids])
+        return { c.hex(): p.hex() for c, p in rows }
 
     def get_patch_id_commits(self, patchid: str) -> list[str]:
-        return self.patchid_idx[patchid]
+        rows = self.db.execute('SELECT commitid FROM commits WHERE patchid = ? ORDER BY rowid',
+                               (bytes.fromhex(patchid),))
+        return [r[0].hex() for r in rows]
 
     def get_title_commits(self, title: str) -> list[str]:
-        return self.title_idx[title]
+        rows = self.db.execute('''SELECT commitid FROM commits
+                                  WHERE titleid = (SELECT titleid FROM titles WHERE title = ?)
+                                  ORDER BY rowid''', (title,))
+        return [r[0].hex() for r in rows]
+
+    def get_normalized_title(self, commitid: str) -> str:
+        row = self.db.execute('''SELECT title FROM commits JOIN titles ON titles.titleid = commits.normtitleid
+                                 WHERE commitid = ?''', (bytes.fromhex(commitid),)).fetchone()
+        if row is None:
+            raise KeyError(commitid)
+        return row[0]
+
+    def get_normalized_title_commits(self, normalized_title: str) -> list[str]:
+        rows = self.db.execute('''SELECT commitid FROM commits
+                                  WHERE normtitleid = (SELECT titleid FROM titles WHERE title = ?)
+                                  ORDER BY rowid''', (normalized_title,))
+        return [r[0].hex() for r in rows]
 
     def get_files(self, commitid: str) -> list[str]:
-        if 'files' not in self.commit_map[commitid]:
-            files = run(f'git diff-tree --no-commit-id --name-only -r {commitid}').split('\n')
-            self.commit_map[commitid]['files'] = files
+        files = self._get('files', commitid)
+        if files is None:
+            files = run(f'git diff-tree --no-commit-id --name-only -r {commitid}')
+            self.db.execute('UPDATE commits SET files = ? WHERE commitid = ?', (files, bytes.fromhex(commitid)))
+            self.db.commit()
+
+        return files.split('\n')
 
-        return self.commit_map[commitid]['files']
+    def num_commits(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM commits').fetchone()[0]
 
     def load(self):
-        if COMMIT_CACHE_FILE.is_file():
-            with open(COMMIT_CACHE_FILE, 'rb') as handle:
-                data = pickle.load(handle)
-                self.commit_map, self.patchid_idx, self.title_idx = data
-            if VERBOSE:
-                print(f'Cache loaded with {len(self.commit_map)} commits')
+        if self.cache_file is None:
+            self.cache_file = get_cache_file()
+
+        self.db = connect_db(self.cache_file)
+
+        # The write lock is taken only if the schema needs to be created or the
+        # normalized titles updated, so that loading doesn't block the other
+        # processes
+        if not self._schema_is_current():
+            self._create_schema()
+
+        if VERBOSE:
+            print(f'Cache {self.cache_file} loaded with {self.num_commits()} commits')
+
+    def _update_normalized_titles(self):
+        if VERBOSE:
+            print('Updating the normalized titles')
+
+        titles = self.db.execute('SELECT DISTINCT titleid, title FROM commits NATURAL JOIN titles').fetchall()
+        normalized = [(titleid, normalize_title(title)) for titleid, title in titles]
+
+        self.db.executemany('INSERT OR IGNORE INTO titles (title) VALUES (?)', ((n,) for _, n in normalized))
+        self.db.executemany('''UPDATE commits SET normtitleid = (SELECT titleid FROM titles WHERE title = ?)
+                               WHERE titleid = ?''', ((n, titleid) for titleid, n in normalized))
+
+    def _schema_is_current(self) -> bool:
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+            return False
+
+        rules = self.db.execute("SELECT value FROM meta WHERE key = 'title_rules'").fetchone()
+        return rules is not None and rules[0] == title_rules_hash()
+
+    def _create_schema(self):
+        # Creates the tables, and updates the normalized titles if the rules
+        # have changed. This is done in a single transaction, so that
+        # concurrent processes don't see a half created cache. Another process
+        # may have done this already while we waited for the lock, so
+        # everything is checked again.
+        self.db.execute('BEGIN IMMEDIATE')
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, self.SCHEMA_VERSION):
+            self.db.rollback()
+            raise RuntimeError(f'Cache {self.cache_file} has an unknown version {version}')
+
+        for statement in self.SCHEMA.split(';'):
+            self.db.execute(statement)
+
+        rules = self.db.execute("SELECT value FROM meta WHERE key = 'title_rules'").fetchone()
+        if rules is None or rules[0] != title_rules_hash():
+            self._update_normalized_titles()
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('title_rules', ?)", (title_rules_hash(),))
+
+        self.db.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.db.commit()
 
     def save(self):
-        with open(COMMIT_CACHE_FILE, 'wb') as handle:
-            data = (self.commit_map, self.patchid_idx, self.title_idx)
-            pickle.dump(data, handle)
+        self.db.commit()
 
         if VERBOSE:
-            print(f'Cache saved with {len(self.commit_map)} commits')
+            print(f'Cache saved with {self.num_commits()} commits')
 
 
 def collect_commits(commitrange):
@@ -84,16 +468,10 @@ def collect_commits(commitrange):
 
     proc = runasync(f'git rev-list --no-merges {commitrange}')
 
-    commits = []
+    commits = [line.rstrip() for line in proc.stdout]
 
-    while True:
-        line = proc.stdout.readline()
-        if line == '' and proc.poll() is not None:
-            break
-
-        line = line.rstrip()
-
-        commits.append(line)
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
     if VERBOSE:
         print(f'{len(commits)} commits')
@@ -103,6 +481,29 @@ def collect_commits(commitrange):
 def shorten_commitid(commitid):
     return run(f'git rev-parse --short {commitid}')
 
+def resolve_range(commitrange):
+    # Returns the range with the refs resolved to object ids. If the resolved
+    # range is unchanged, the range still contains the same commits.
+    return ' '.join(run(f'git rev-parse {commitrange}').split())
+
+def load_state(state_file):
+    # Returns the state stored by save_state(), or None
+    if not Path(state_file).is_file():
+        return None
+
+    with open(state_file, 'rb') as handle:
+        return pickle.load(handle)
+
+def save_state(state_file, state):
+    # Write to a temporary file and rename, so that an interrupted run never
+    # leaves a truncated state file behind
+    tmp_file = f'{state_file}.tmp'
+
+    with open(tmp_file, 'wb') as handle:
+        pickle.dump(state, handle)
+
+    os.replace(tmp_file, state_file)
+
 class Result:
     def __init__(self, commitid: str, title: str, found):
         self.commitid = commitid
@@ -110,15 +511,313 @@ class Result:
         # {'upstream': ('2c377d8a71db32d4125d30b3641f2bc51c6850ca', 'CommitID')}
         self.found = found
 
-def range_compare(branches, show_only_branch, match_by_title, drop_common):
+class Membership:
+    # The branches containing each patch-id equivalence class, as an integer
+    # bitmask with bit i set if the class is in the i-th branch. Empty
+    # commits have no patch-id, so each of them is a class of its own.
+    #
+    # E.g. the classes in 'a' and 'c' but not in 'b':
+    #   m.query(present=['a', 'c'], absent=['b'])
+
+    def __init__(self, names: list[str]) -> None:
+        self.names = list(names)
+        # { class: bitmask }, in the order the classes were first seen
+        self.masks = {}
+        # { class: [commitid, ...] }, the commits of the class in all branches
+        self.commits = {}
+        # { class: title of its first commit }
+        self.titles = {}
+
+    def mask(self, names) -> int:
+        mask = 0
+        for name in names:
+            mask |= 1 << self.names.index(name)
+        return mask
+
+    def branch_names(self, mask: int) -> list[str]:
+        return [name for i, name in enumerate(self.names) if mask & (1 << i)]
+
+    def query(self, present=(), absent=()) -> list:
+        # Returns the classes in all the present branches and in none of the
+        # absent ones
+        present = self.mask(present)
+        absent = self.mask(absent)
+        return [key for key, mask in self.masks.items()
+                if mask & present == present and not mask & absent]
+
+    def mask_counts(self) -> dict:
+        # Returns { bitmask: number of classes }. There are usually far fewer
+        # distinct bitmasks than classes, so the summaries below are computed
+        # from these.
+        counts = {}
+        for mask in self.masks.values():
+            counts[mask] = counts.get(mask, 0) + 1
+        return counts
+
+    def branch_counts(self) -> dict:
+        # Returns { branch-name: number of classes in the branch }
+        counts = dict.fromkeys(self.names, 0)
+        for mask, count in self.mask_counts().items():
+            for name in self.branch_names(mask):
+                counts[name] += count
+        return counts
+
+    def overlaps(self) -> dict:
+        # Returns { (branch-name, branch-name): number of classes in both }
+        mask_counts = self.mask_counts()
+        overlaps = {}
+        for i, a in enumerate(self.names):
+            for j in range(i + 1, len(self.names)):
+                pair = (1 << i) | (1 << j)
+                overlaps[(a, self.names[j])] = sum(count for mask, count in mask_counts.items()
+                                                   if mask & pair == pair)
+        return overlaps
+
+def branch_membership(branches, jobs=1) -> Membership:
+    # Returns the Membership of the patch-ids of the commits in the branches
+    # ({ branch-name: range }). Unlike range_compare(), the commits are not
+    # searched for in each branch: each commit just sets its branch's bit in
+    # its class, so the cost is linear in the number of commits.
+
+    branch_commits = { name: collect_commits(range) for name,range in branches.items() }
+
+    flattened = [item for sublist in branch_commits.values() for item in sublist]
+
+    cache = CommitCache()
+    cache.load()
+    cache.add_commits(flattened, jobs)
+    cache.save()
+
+    patchids = cache.get_patch_ids(list(dict.fromkeys(flattened)))
+
+    membership = Membership(branches)
+
+    # { class: { commitid: None } }, to drop the commits in multiple branches
+    # while keeping the order
+    class_commits = {}
+
+    for i, commits in enumerate(branch_commits.values()):
+        bit = 1 << i
+        for c in commits:
+            key = patchids[c] or c
+            membership.masks[key] = membership.masks.get(key, 0) | bit
+            class_commits.setdefault(key, {})[c] = None
+
+    for key, commits in class_commits.items():
+        membership.commits[key] = list(commits)
+        membership.titles[key] = cache.get_title(membership.commits[key][0])
+
+    return membership
+
+def collect_branches(branches, old_state=None):
+    # Collects the commits in the branches ({ branch-name: range }). The
+    # ranges which have not changed since the previous run (old_state) are
+    # not collected again.
+    #
+    # Returns (tips, branch_commits, changed):
+    #   tips: { branch-name: resolved range }
+    #   branch_commits: { branch-name: [commits] }
+    #   changed: the commits added to or removed from the ranges since the
+    #            previous run
+
+    tips = { name: resolve_range(range) for name,range in branches.items() }
+
+    changed = set()
+
+    branch_commits = {}
+    for name,range in branches.items():
+        if old_state and old_state['tips'][name] == tips[name]:
+            branch_commits[name] = old_state['commits'][name]
+            continue
+
+        branch_commits[name] = collect_commits(range)
+
+        if old_state:
+            changed |= set(old_state['commits'][name]) ^ set(branch_commits[name])
+
+    return tips, branch_commits, changed
+
+def build_fuzzy_indexes(branch_commits, jobs=1):
+    # Returns (signatures, fuzzy_indexes) for the branches
+    # ({ branch-name: [commits] }), see fuzzy_match.py:
+    #   signatures: { commitid: MinHash signature }
+    #   fuzzy_indexes: { branch-name: LSHIndex }
+
+    import fuzzy_match # pylint: disable=import-outside-toplevel
+
+    flattened = [item for sublist in branch_commits.values() for item in sublist]
+
+    signature_cache = fuzzy_match.SignatureCache()
+    signature_cache.load()
+    signature_cache.add_commits(flattened, jobs)
+    signatures = signature_cache.get_signatures(flattened)
+
+    fuzzy_indexes = {}
+    for name,commits in branch_commits.items():
+        fuzzy_indexes[name] = fuzzy_match.LSHIndex()
+        for c in commits:
+            if c in signatures:
+                fuzzy_indexes[name].add(c, signatures[c])
+
+    return signatures, fuzzy_indexes
+
+def affected_commits(cache, changed, commits, match_by_title, match_by_normalized_title):
+    # Returns the commits whose search result can have changed because of the
+    # changed commits: the changed commits themselves, and the ones sharing a
+    # patch-id or (normalized) title with them.
+
+    if not changed:
+        return set()
+
+    changed_pids = { cache.get_patch_id(c) for c in changed }
+    changed_titles = { cache.get_title(c) for c in changed } if match_by_title else set()
+    changed_normalized_titles = ({ cache.get_normalized_title(c) for c in changed }
+                                 if match_by_normalized_title else set())
+
+    return { c for c in commits
+             if c in changed or
+             cache.get_patch_id(c) in changed_pids or
+             (match_by_title and cache.get_title(c) in changed_titles) or
+             (match_by_normalized_title and
+              cache.get_normalized_title(c) in changed_normalized_titles) }
+
+def reusable_results(old_found, affected, branches, fuzzy):
+    # Returns the results of the previous run ({ commitid: found }) which are
+    # still valid, i.e. those of the commits not affected by the changes.
+    # The fuzzy matches, or the lack of them, depend on all the commits in the
+    # branches, so the results with fuzzy or missing matches are not reused
+    # if fuzzy is set.
+
+    return { c: found for c, found in old_found.items()
+             if c not in affected and
+             (not fuzzy or all(b in found and not found[b][1].startswith('Fuzzy')
+                               for b in branches)) }
+
+class BranchSearch:
+    # Searches for commits in the branches ({ branch-name: [commits] }), by
+    # commit id, patch-id, title (if match_by_title is set), normalized title
+    # (if match_by_normalized_title is set), and similarity (for the commits
+    # in signatures, see build_fuzzy_indexes()), in that order.
+
+    def __init__(self, cache, branch_commits, match_by_title, match_by_normalized_title,
+                 signatures=None, fuzzy_indexes=None):
+        self.cache = cache
+        # { branch-name: set(commits) }, for fast membership tests
+        self.branch_sets = { name: set(commits) for name,commits in branch_commits.items() }
+        self.match_by_title = match_by_title
+        self.match_by_normalized_title = match_by_normalized_title
+        self.signatures = signatures or {}
+        self.fuzzy_indexes = fuzzy_indexes or {}
+
+    def search(self, commitid, branch_name):
+        # Returns (commitid, how) for the commit found in the branch, or None
+        commits = self.branch_sets[branch_name]
+
+        if commitid in commits:
+            return (commitid, 'CommitID')
+
+        pid = self.cache.get_patch_id(commitid)
+        for c in self.cache.get_patch_id_commits(pid):
+            if c in commits:
+                return (c, 'PatchID')
+
+        if self.match_by_title:
+            title = self.cache.get_title(commitid)
+            for c in self.cache.get_title_commits(title):
+                if c in commits:
+                    return (c, 'Title')
+
+        if self.match_by_normalized_title:
+            normalized_title = self.cache.get_normalized_title(commitid)
+            for c in self.cache.get_normalized_title_commits(normalized_title):
+                if c in commits:
+                    return (c, 'NormTitle')
+
+        if commitid in self.signatures:
+            matches = self.fuzzy_indexes[branch_name].query(self.signatures[commitid])
+            if matches:
+                c, score = matches[0]
+                return (c, f'Fuzzy {score:.2f}')
+
+        return None
+
+    def search_all(self, commitids, reusable=None):
+        # Returns { commitid: { branch-name: (commitid, how) } } for the
+        # commits. The results in reusable ({ commitid: found }, see
+        # reusable_results()) are used instead of searching again.
+
+        all_found = {}
+
+        num_reused = 0
+        timestamp = 0
+        for i, commitid in enumerate(commitids):
+            if time.time() > timestamp + 10:
+                if VERBOSE:
+                    print(f'  {i}/{len(commitids)}')
+                timestamp = time.time()
+
+            if reusable and commitid in reusable:
+                all_found[commitid] = reusable[commitid]
+                num_reused += 1
+                continue
+
+            found = {}
+            for b in self.branch_sets:
+                res = self.search(commitid, b)
+
+                if not res:
+                    continue
+
+                found[b] = res
+
+            all_found[commitid] = found
+
+        if VERBOSE:
+            print(f'  {len(commitids)}/{len(commitids)}')
+            if reusable is not None:
+                print(f'Reused {num_reused} results from the previous run')
+
+        return all_found
+
+def range_compare(branches, show_only_branch, match_by_title, drop_common, jobs=1,
+                  state_file=None, timings=None, fuzzy=False, match_by_normalized_title=False):
+    # If match_by_normalized_title is set, commits not found by title are
+    # searched for by their normalized title (see normalize_title()), and
+    # found as 'NormTitle'.
+    #
+    # If fuzzy is set, commits not found otherwise are searched for by
+    # similarity (see fuzzy_match.py), and found as 'Fuzzy <similarity>'.
+    #
+    # If state_file is given, the results are stored there, together with the
+    # resolved ranges. On the next run only the ranges which have changed are
+    # collected again, and only the commits affected by the added or removed
+    # commits are searched again.
+    #
+    # If timings is given, the time (in seconds) spent in each phase is stored
+    # there: { 'collect': t, 'ingest': t, 'search': t }
+
+    if timings is None:
+        timings = {}
+
+    timestamp_phase = time.perf_counter()
+
+    old_state = load_state(state_file) if state_file else None
+
+    options = (sorted(branches), match_by_title, fuzzy,
+               title_rules_hash() if match_by_normalized_title else None)
+    if old_state and old_state['options'] != options:
+        old_state = None
+
     # Collect commits
 
-    # { branch-name: [commits]}
-    branches = { name: collect_commits(range) for name,range in branches.items() }
+    tips, branches, changed = collect_branches(branches, old_state)
 
     # Flattened list of all commits
     flattened = [item for sublist in branches.values() for item in sublist]
 
+    timings['collect'] = time.perf_counter() - timestamp_phase
+    timestamp_phase = time.perf_counter()
+
     if VERBOSE:
         print('Generating database')
 
@@ -127,36 +826,18 @@ def range_compare(branches, show_only_branch, match_by_title, drop_common):
     cache = CommitCache()
     cache.load()
 
-    i = 0
-    timestamp = 0
-    for commitid in flattened:
-        if time.time() > timestamp + 10:
-            if VERBOSE:
-                print(f'  {i}/{len(flattened)}')
-            timestamp = time.time()
-        i += 1
-        cache.add_commit(commitid)
-    if VERBOSE:
-        print(f'  {i}/{len(flattened)}')
+    # The removed commits are needed to find the affected commits
+    cache.add_commits(flattened + list(changed), jobs)
 
     cache.save()
 
-    def search_for_commit_in_branch(commitid, branch_name):
-        if commitid in branches[branch_name]:
-            return (commitid, 'CommitID')
+    signatures, fuzzy_indexes = build_fuzzy_indexes(branches, jobs) if fuzzy else ({}, {})
 
-        pid = cache.get_patch_id(commitid)
-        for c in cache.get_patch_id_commits(pid):
-            if c in branches[branch_name]:
-                return (c, 'PatchID')
+    timings['ingest'] = time.perf_counter() - timestamp_phase
+    timestamp_phase = time.perf_counter()
 
-        if match_by_title:
-            title = cache.get_title(commitid)
-            for c in cache.get_title_commits(title):
-                if c in branches[branch_name]:
-                    return (c, 'Title')
-
-        return None
+    branch_search = BranchSearch(cache, branches, match_by_title, match_by_normalized_title,
+                                 signatures, fuzzy_indexes)
 
     # Search commits
 
@@ -165,23 +846,19 @@ def range_compare(branches, show_only_branch, match_by_title, drop_common):
     else:
         commit_list = flattened
 
-    datas = []
-
-    timestamp = 0
-    for i, commitid in enumerate(commit_list):
-        if time.time() > timestamp + 10:
-            if VERBOSE:
-                print(f'  {i}/{len(commit_list)}')
-            timestamp = time.time()
+    reusable = None
+    if old_state:
+        affected = affected_commits(cache, changed, old_state['found'].keys() & set(commit_list),
+                                    match_by_title, match_by_normalized_title)
+        reusable = reusable_results(old_state['found'], affected, branches, fuzzy)
 
-        found = {}
-        for b in branches:
-            res = search_for_commit_in_branch(commitid, b)
+    # { commitid: found }, for the state file
+    all_found = branch_search.search_all(commit_list, reusable)
 
-            if not res:
-                continue
+    datas = []
 
-            found[b] = res
+    for commitid in commit_list:
+        found = all_found[commitid]
 
         is_common = len(found) == len(branches)
         if drop_common and is_common:
@@ -191,7 +868,10 @@ def range_compare(branches, show_only_branch, match_by_title, drop_common):
 
         datas.append(data)
 
-    if VERBOSE:
-        print(f'  {len(commit_list)}/{len(commit_list)}')
+    timings['search'] = time.perf_counter() - timestamp_phase
+
+    if state_file:
+        save_state(state_file, { 'options': options, 'tips': tips,
+                                 'commits': branches, 'found': all_found })
 
     return datas